@@ -4,6 +4,7 @@ import gc
 import json
 import logging
 import os
+import re
 import shutil
 import tempfile
 import urllib.parse
@@ -15,6 +16,7 @@ from urllib.parse import urlparse
 
 import draccus
 import equinox as eqx
+import filelock
 import fsspec
 import huggingface_hub
 import jax
@@ -787,6 +789,79 @@ def load_tokenizer(model_name_or_path, revision=None, local_cache_dir=None, trus
         )
 
 
+def load_tokenizer_with_local_cache(model_name_or_path, revision=None, cache_dir=None, trust_remote_code=True):
+    """
+    Like load_tokenizer, but for HF Hub tokenizers: the first load of a given commit saves the tokenizer to a local
+    directory, and later loads (e.g. in freshly launched workers) read it from there instead of downloading it again.
+    A file lock keeps processes sharing a filesystem from all downloading it at once.
+
+    Entries are keyed by commit hash. If `revision` is already a full commit hash, no network access is needed at all.
+    Otherwise `revision` (default: the main branch) is resolved to its current commit on the Hub first, so updates to
+    the Hub copy are picked up. If that lookup fails (e.g. offline), this falls back to `load_tokenizer`.
+
+    The cache lives in `cache_dir`, or `$LEVANTER_HF_CACHE` if that's not provided, or `~/.cache/levanter/hf`. Each
+    entry is a directory named `<org>--<name>--<commit>`; it's safe to delete any of them (or the whole cache
+    directory) to clear the cache.
+    """
+    is_url_like = urlparse(model_name_or_path).scheme != ""
+    if is_url_like or os.path.exists(model_name_or_path):
+        return load_tokenizer(model_name_or_path, revision=revision, trust_remote_code=trust_remote_code)
+
+    commit = _resolve_hub_commit(model_name_or_path, revision)
+    if commit is None:
+        return load_tokenizer(model_name_or_path, revision=revision, trust_remote_code=trust_remote_code)
+
+    if cache_dir is None:
+        cache_dir = os.environ.get("LEVANTER_HF_CACHE", os.path.expanduser("~/.cache/levanter/hf"))
+
+    local_path = os.path.join(cache_dir, f"{model_name_or_path.replace('/', '--')}--{commit}")
+    if not os.path.exists(local_path):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            lock = filelock.FileLock(f"{local_path}.lock")
+            lock.acquire()
+        except OSError as e:
+            # e.g. a read-only home directory. The cache is just an optimization
+            logger.warning(f"Can't cache tokenizer {model_name_or_path} in {cache_dir}, loading it directly: {e}")
+            return load_tokenizer(model_name_or_path, revision=commit, trust_remote_code=trust_remote_code)
+
+        try:
+            if not os.path.exists(local_path):
+                tokenizer = load_tokenizer(model_name_or_path, revision=commit, trust_remote_code=trust_remote_code)
+                _save_tokenizer_to_cache(tokenizer, cache_dir, local_path)
+                return tokenizer
+        finally:
+            lock.release()
+
+    return AutoTokenizer.from_pretrained(local_path, trust_remote_code=trust_remote_code)
+
+
+def _resolve_hub_commit(repo_id: str, revision: Optional[str]) -> Optional[str]:
+    """Returns the commit hash `revision` currently points to on the Hub, or None if it can't be determined."""
+    if revision is not None and re.fullmatch("[0-9a-f]{40}", revision):
+        return revision
+
+    try:
+        return huggingface_hub.HfApi().model_info(repo_id, revision=revision).sha
+    except Exception as e:  # noqa
+        logger.warning(f"Couldn't resolve {repo_id}@{revision or 'main'} on the Hub, not using the local cache: {e}")
+        return None
+
+
+def _save_tokenizer_to_cache(tokenizer, cache_dir: str, local_path: str):
+    # save somewhere else first so that nobody sees a partially written tokenizer
+    tmp_path = None
+    try:
+        tmp_path = tempfile.mkdtemp(dir=cache_dir)
+        tokenizer.save_pretrained(tmp_path)
+        os.rename(tmp_path, local_path)
+    except OSError as e:
+        logger.warning(f"Failed to save tokenizer to {local_path}: {e}")
+    finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
 _sync_count = 0
 
 
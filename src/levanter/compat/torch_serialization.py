@@ -175,7 +175,9 @@ def default_update_state_dict_with_eqx_module(
     return state_dict
 
 
-def flatten_linear_layers(prefix: Optional[str], tree: PyTree, out_dims_first_in_dict: Optional[bool]) -> StateDict:
+def flatten_linear_layers(
+    prefix: Optional[str], tree: PyTree, out_dims_first_in_dict: Optional[bool], out: Optional[StateDict] = None
+) -> StateDict:
     """
     In PyTorch, linear layers are stored as a 2d weight matrix and a 1d bias vector. In Haliax,
     linear layers can have arbitrary dimensions, grouped into input and output axes. This function
@@ -190,9 +192,11 @@ def flatten_linear_layers(prefix: Optional[str], tree: PyTree, out_dims_first_in
     :param out_dims_first_in_dict: if True, the output dimensions will be the first axis in the flattened weight matrix.
     If False, the input dimensions will be the first axis. If None, the weight's axes will be left as-is.
     This is the default in PyTorch, but not in Haliax.
+    :param out: if provided, the flattened layers are written into this state dict (which is returned) instead of a
+    new one.
     """
 
-    ret_dict: StateDict = {}
+    ret_dict: StateDict = out if out is not None else {}
 
     def _flatten_linear(layer, prefix):
         if not isinstance(layer, hnn.Linear):
@@ -374,8 +378,8 @@ def to_numpy_state_dict(model, prefix: Optional[str] = None) -> StateDict:
             elif isinstance(arr, np.ndarray):
                 return arr
             elif arr.is_fully_addressable:
-                r = np.array(arr)
-                return r
+                # fetched below, together with everything else
+                return arr
             else:
                 # unfortunately, jax's allgather seems to replicate to every device rather than every host
                 # which doesn't work for ~7B parameter models on TPU (assuming we also have optimizer state)
@@ -403,6 +407,9 @@ def to_numpy_state_dict(model, prefix: Optional[str] = None) -> StateDict:
 
         # need to make sure the model is on *this machine* and *this machine's CPU* before saving
         model = jax.tree_util.tree_map(lambda arr: get_to_cpu(arr), model)
+        # one device_get for the whole tree issues all the device->host copies up front instead of blocking on
+        # each parameter in turn
+        model = jax.device_get(model)
         # TODO: it would be nice if safetensors supported an iterator or something so we could do the allgather one at a time
         state_dict = model.to_state_dict(prefix=prefix)
         return state_dict
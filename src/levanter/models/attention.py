@@ -46,7 +46,8 @@ def dot_product_attention(
         attention_dtype: Optional dtype to use for attention
         precision: PrecisionLike for dot product. See precision argument to jax.lax.dot_general
         use_flash: whether to use flash attention
-        flash_block_size: block size for flash attention. If None, will use an appropriate default
+        flash_block_size: block size for flash attention. If None, will use an appropriate default. If the query or key
+            length isn't a multiple of it, regular attention is used instead.
         dropout: dropout rate
         inference: whether to use inference mode
         prng: PRNGKeyArray for dropout
@@ -57,11 +58,19 @@ def dot_product_attention(
         raise ValueError("QPos and KPos must be different")
 
     if use_flash:
-        from levanter.models.flash_attention import BLOCK_SIZE, flash_attention
+        from levanter.models.flash_attention import BLOCK_SIZE
 
         if flash_block_size is None:
             flash_block_size = BLOCK_SIZE
 
+        # flash attention works in whole blocks. Shorter or odd lengths (e.g. decoding) use regular attention instead
+        if query.axis_size(QPos) % flash_block_size != 0 or key.axis_size(KPos) % flash_block_size != 0:
+            use_flash = False
+
+    if use_flash:
+        from levanter.models.flash_attention import flash_attention
+
+        assert flash_block_size is not None
         return flash_attention(
             QPos,
             KPos,
@@ -109,6 +118,8 @@ class AttentionMask(eqx.Module):
 
     is_causal: bool = eqx.static_field()
     explicit_mask: Optional[NamedArray] = None
+    # if set, each query position may only attend to the `sliding_window` most recent key positions (inclusive)
+    sliding_window: Optional[int] = eqx.static_field(default=None)
     # TODO: add sequence packing
     # TODO: add prefixlm
     # cf https://github.com/google-research/t5x/blob/51a99bff8696c373cc03918707ada1e98cbca407/t5x/examples/decoder_only/layers.py#L978
@@ -130,30 +141,61 @@ class AttentionMask(eqx.Module):
         else:
             causal = None
 
+        if self.sliding_window is not None:
+            window = sliding_window_mask(
+                QPos.resize(q_slice.size), KPos.resize(k_slice.size), self.sliding_window, q_slice.start, k_slice.start
+            )
+        else:
+            window = None
+
         if self.explicit_mask is not None:
             explicit = self.explicit_mask[QPos, q_slice, KPos, k_slice]
         else:
             explicit = None
 
-        return combine_masks_and(causal, explicit)
+        return combine_masks_and(combine_masks_and(causal, window), explicit)
 
     @staticmethod
-    def causal() -> "AttentionMask":
-        return AttentionMask(is_causal=True)
+    def causal(sliding_window: Optional[int] = None) -> "AttentionMask":
+        return AttentionMask(is_causal=True, sliding_window=sliding_window)
 
     @staticmethod
     def explicit(mask: NamedArray) -> "AttentionMask":
         return AttentionMask(is_causal=False, explicit_mask=mask)
 
+    def with_sliding_window(self, sliding_window: Optional[int]) -> "AttentionMask":
+        """Returns a copy of this mask that additionally restricts attention to a sliding window"""
+        return AttentionMask(is_causal=self.is_causal, explicit_mask=self.explicit_mask, sliding_window=sliding_window)
+
     def __and__(self, other) -> "AttentionMask":
         is_causal = self.is_causal and other.is_causal
         explicit_mask = combine_masks_and(self.explicit_mask, other.explicit_mask)
-        return AttentionMask(is_causal=is_causal, explicit_mask=explicit_mask)
+        if self.sliding_window is None:
+            sliding_window = other.sliding_window
+        elif other.sliding_window is None:
+            sliding_window = self.sliding_window
+        else:
+            sliding_window = min(self.sliding_window, other.sliding_window)
+        return AttentionMask(is_causal=is_causal, explicit_mask=explicit_mask, sliding_window=sliding_window)
 
     def __or__(self, other) -> "AttentionMask":
         is_causal = self.is_causal or other.is_causal
         explicit_mask = combine_masks_or(self.explicit_mask, other.explicit_mask)
-        return AttentionMask(is_causal=is_causal, explicit_mask=explicit_mask)
+        if self.sliding_window is None or other.sliding_window is None:
+            sliding_window = None
+        else:
+            sliding_window = max(self.sliding_window, other.sliding_window)
+        return AttentionMask(is_causal=is_causal, explicit_mask=explicit_mask, sliding_window=sliding_window)
+
+
+def sliding_window_mask(QPos: Axis, KPos: Axis, sliding_window: int, q_start=0, k_start=0) -> NamedArray:
+    """
+    Creates a mask that only allows a query position to attend to key positions less than `sliding_window` behind it.
+    This does not mask out future positions, so you typically want to combine it with a causal mask.
+    """
+    q_pos = haliax.arange(QPos) + q_start
+    k_pos = haliax.arange(KPos) + k_start
+    return (q_pos.broadcast_axis(KPos) - k_pos.broadcast_axis(QPos)) < sliding_window
 
 
 @overload
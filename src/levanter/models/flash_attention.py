@@ -6,6 +6,7 @@ from typing import Optional, Tuple
 import equinox
 import jax
 import jax.numpy as jnp
+import numpy as np
 from equinox import filter_eval_shape
 from jaxtyping import PRNGKeyArray
 
@@ -136,6 +137,9 @@ def _flash_attention_forward(
     Tr = QPos.size // block_size
     Tc = KPos.size // block_size
 
+    # for causal and sliding window masks, we only need to visit a band of KV blocks for each Q block
+    kv_block_offsets, kv_block_limits, _, _ = _block_ranges(mask, Tr, Tc, block_size)
+
     q_batch_axes: Tuple[hax.Axis, ...] = hax.eliminate_axes(q.axes, (QPos, Key))
 
     # output variables: O is the attention output, ell is the per-position log normalizer
@@ -187,8 +191,6 @@ def _flash_attention_forward(
                 mask_ij = _materialize_mask_slice(mask, i, j, QPos, KPos, block_size)
                 attn_ij = hax.where(mask_ij, attn_ij, -1e10)
 
-            # TODO: block causal
-
             if dropout > 0 and not inference:
                 attn_ij = hax.nn.dropout(attn_ij, dropout, inference=False, key=jax.random.fold_in(key, i * Tc + j))
 
@@ -206,7 +208,9 @@ def _flash_attention_forward(
             return (i, j + 1, o_i, q_i, sumexp_i, max_i)
 
         _, _, o_i, _, sumexp_i, max_i = jax.lax.while_loop(
-            lambda state: state[1] < Tc, do_qk_block, (i, 0, o_i, q_i, sumexp_i, max_i)
+            lambda state: state[1] < kv_block_limits[i],
+            do_qk_block,
+            (i, kv_block_offsets[i], o_i, q_i, sumexp_i, max_i),
         )
 
         # Step 12: compute O_i = diag(\ell_i^{Tc})^{-1} O_i^{Tc}
@@ -234,7 +238,7 @@ def _flash_attention_backward(
     QPos: hax.Axis,
     KPos: hax.Axis,
     Key: hax.AxisSelector,
-    mask: Optional[hax.NamedArray] = None,
+    mask: Optional[AttentionMask | hax.NamedArray] = None,
     bias: Optional[hax.NamedArray] = None,
     dropout: float = 0.0,
     *,
@@ -254,6 +258,8 @@ def _flash_attention_backward(
     if isinstance(mask, hax.NamedArray):
         mask = mask.broadcast_axis((QPos, KPos))  # make sure mask is broadcastable
 
+    _, _, q_block_offsets, q_block_limits = _block_ranges(mask, Tr, Tc, block_size)
+
     # Compute D = rowsum(dO * O), write D to HBM and divide it into Tr blocks of size Br each.
     # in the FA2 paper D is said to be \in R^{d}, but that doesn't make sense.
     # Triton impl has it as R^{QPos}, which makes more sense.
@@ -314,7 +320,9 @@ def _flash_attention_backward(
             return i + 1, j, dQ, dK_j, dV_j
 
         # dQ, dK_j, dV_j = hax.fold(do_inner_block, Tr)((dQ, dK_j, dV_j), jnp.arange(Tr.size))
-        i, j, dQ, dK_j, dV_j = jax.lax.while_loop(lambda state: state[0] < Tr, do_inner_block, (0, j, dQ, dK_j, dV_j))
+        i, j, dQ, dK_j, dV_j = jax.lax.while_loop(
+            lambda state: state[0] < q_block_limits[j], do_inner_block, (q_block_offsets[j], j, dQ, dK_j, dV_j)
+        )
 
         dK = dK.updated_slice({KPos: j * block_size}, dK_j)
         dV = dV.updated_slice({KPos: j * block_size}, dV_j)
@@ -337,3 +345,43 @@ def _infer_attention_output_block_shape(QPos, KPos, Key, q_i, k, v):
 
 def _materialize_mask_slice(mask, i, j, QPos, KPos, block_size):
     return materialize_mask(mask, QPos, KPos, q_slice=hax.ds.block(i, block_size), k_slice=hax.ds.block(j, block_size))
+
+
+def _block_ranges(mask, Tr: int, Tc: int, block_size: int) -> Tuple[jax.Array, jax.Array, jax.Array, jax.Array]:
+    """
+    Computes which blocks of the attention matrix can contain unmasked entries, so that we can skip the rest.
+    Returns (kv_offsets, kv_limits, q_offsets, q_limits): for each Q block i, KV blocks [kv_offsets[i], kv_limits[i])
+    need to be visited, and for each KV block j, Q blocks [q_offsets[j], q_limits[j]) need to be visited.
+
+    This is only done for the structured parts of an [AttentionMask][] (causal and sliding window), which are known
+    at trace time. Explicit masks are still applied inside every visited block.
+    """
+    q_blocks = np.arange(Tr)[:, None]
+    k_blocks = np.arange(Tc)[None, :]
+    # smallest and largest (query position - key position) within each block
+    min_diff = (q_blocks - k_blocks) * block_size - (block_size - 1)
+    max_diff = (q_blocks - k_blocks) * block_size + (block_size - 1)
+
+    live = np.ones((Tr, Tc), dtype=bool)
+    if isinstance(mask, AttentionMask):
+        if mask.is_causal:
+            live &= max_diff >= 0
+        if mask.sliding_window is not None:
+            live &= min_diff < mask.sliding_window
+
+    # a Q block with nothing to attend to would have a zero normalizer, so just visit everything like we used to
+    live[~live.any(axis=1)] = True
+
+    kv_offsets = live.argmax(axis=1)
+    kv_limits = Tc - live[:, ::-1].argmax(axis=1)
+
+    has_q = live.any(axis=0)
+    q_offsets = np.where(has_q, live.argmax(axis=0), 0)
+    q_limits = np.where(has_q, Tr - live[::-1, :].argmax(axis=0), 0)
+
+    return (
+        jnp.asarray(kv_offsets, dtype=jnp.int32),
+        jnp.asarray(kv_limits, dtype=jnp.int32),
+        jnp.asarray(q_offsets, dtype=jnp.int32),
+        jnp.asarray(q_limits, dtype=jnp.int32),
+    )
@@ -1,4 +1,6 @@
 import dataclasses
+import functools
+import math
 from dataclasses import dataclass
 from typing import Callable, Dict, Optional, Tuple, Type, Union
 
@@ -11,7 +13,7 @@ from jaxtyping import PRNGKeyArray
 import haliax as hax
 import haliax.nn as hnn
 from haliax import Axis, AxisSpec, NamedArray
-from haliax.jax_utils import maybe_rng_split, named_call, shaped_rng_split
+from haliax.jax_utils import is_jax_array_like, maybe_rng_split, named_call, shaped_rng_split
 from haliax.nn.scan import Stacked
 
 from levanter.compat.hf_checkpoints import HFCheckpointConverter, HFCompatConfig
@@ -52,6 +54,15 @@ class LlamaConfig(HFCompatConfig):
             Note that num_heads must be divisible by this number. Defaults to 32.
         activation_function (str, optional): activation function for the hidden layer. Defaults to "silu".
         rope_scaling (Dict, optional): dict containing the scaling configuration for the Rotary Positional Embedding.
+        gradient_checkpointing_block_size (int, optional): number of layers per gradient checkpointing segment. Only
+            segment inputs are kept for the backward pass. If None, uses ~sqrt(num_layers), which minimizes memory.
+            Rounded down to a divisor of num_layers. Defaults to 1, which checkpoints each layer on its own.
+        gradient_checkpointing_policy (str, optional): name of a `jax.checkpoint_policies` policy deciding what each
+            layer saves while its segment is being recomputed. None saves everything, so each segment is recomputed
+            exactly once. Defaults to None.
+        fuse_qkv (bool, optional): whether to compute the query, key and value projections with a single matmul.
+            Checkpoints are still read and written with separate q_proj/k_proj/v_proj, but LoRA can't target the fused
+            projection. Defaults to False.
     """
 
     seq_len: int = 2048
@@ -68,9 +79,11 @@ class LlamaConfig(HFCompatConfig):
     upcast_attn: bool = False
     use_flash_attention: bool = False
     flash_attention_block_size: Optional[int] = None
+    fuse_qkv: bool = False
 
     gradient_checkpointing: bool = True
-    gradient_checkpointing_block_size: int = 5
+    gradient_checkpointing_block_size: Optional[int] = 1
+    gradient_checkpointing_policy: Optional[str] = None
 
     use_bias: bool = False
     rope_scaling: Optional[dict] = None
@@ -90,6 +103,20 @@ class LlamaConfig(HFCompatConfig):
             self.num_heads % self.num_kv_heads == 0
         ), f"num_heads={self.num_heads} not divisible by num_kv_heads={self.num_kv_heads}."
 
+    @property
+    def checkpoint_segment_size(self) -> int:
+        """Number of layers per gradient checkpointing segment. See gradient_checkpointing_block_size."""
+        if self.gradient_checkpointing_block_size is None:
+            # the sqrt(L) schedule: L/k saved segment inputs + k recomputed layers is minimized at k = sqrt(L)
+            block_size = max(1, round(math.sqrt(self.num_layers)))
+        else:
+            block_size = max(1, min(self.gradient_checkpointing_block_size, self.num_layers))
+
+        while self.num_layers % block_size != 0:
+            block_size -= 1
+
+        return block_size
+
     @cached_classproperty
     def default_hf_checkpoint_converter(cls) -> HFCheckpointConverter["LlamaConfig"]:  # type: ignore
         return HFCheckpointConverter(
@@ -152,6 +179,10 @@ class LlamaMlp(eqx.Module, StateDictSerializationMixin):
     """Multi-layer Perceptron
     In comparison with GPT2, LlamaMlp adds an up-proj that multiplies with activated gate_proj,
     before down-proj.
+
+    The MLP is rematerialized with the `dots_saveable` policy, for Llama and every model built on it (e.g. Mistral):
+    the backward pass keeps the gate and up projections and recomputes act(gate) * up, trading a little compute for
+    one fewer [..., mlp]-sized activation per layer. Nothing is fused beyond what XLA does on its own.
     """
 
     gate_proj: hnn.Linear  # projection from Embed to Mlp
@@ -175,11 +206,15 @@ class LlamaMlp(eqx.Module, StateDictSerializationMixin):
     @named_call
     def __call__(self, x: NamedArray, *, key=None) -> NamedArray:
         k_gate, k_up, k_down = maybe_rng_split(key, 3)
-        hidden_states = self.gate_proj(x, key=k_gate)
-        hidden_states = self.act(hidden_states)
-        hidden_states = hidden_states * self.up_proj(x, key=k_up)
-        outputs = self.down_proj(hidden_states, key=k_down)
-        return outputs
+
+        # Only the two projections are saved for the backward pass. act(gate) * up is cheap to recompute and is as
+        # large as either of them, so we don't keep it in HBM between the forward and backward passes.
+        @functools.partial(jax.checkpoint, policy=jax.checkpoint_policies.dots_saveable, prevent_cse=False)
+        def _remat_swiglu(x):
+            hidden_states = self.act(self.gate_proj(x, key=k_gate)) * self.up_proj(x, key=k_up)
+            return self.down_proj(hidden_states, key=k_down)
+
+        return _remat_swiglu(x)
 
     def from_state_dict(self, state_dict: StateDict, prefix: Optional[str] = None):
         # unflatten the linear layers of HF state_dict to match the shape of LlamaMlp
@@ -266,11 +301,13 @@ class LlamaRotaryEmbedding(eqx.Module, StateDictSerializationMixin):
 
 class LlamaAttention(StateDictSerializationMixin, eqx.Module):
     config: LlamaConfig = eqx.static_field()
-    q_proj: hnn.Linear  # projection from Embed to query
-    k_proj: hnn.Linear  # projection from Embed to key
-    v_proj: hnn.Linear  # projection from Embed to value
+    q_proj: Optional[hnn.Linear]  # projection from Embed to query. None if fuse_qkv
+    k_proj: Optional[hnn.Linear]  # projection from Embed to key. None if fuse_qkv
+    v_proj: Optional[hnn.Linear]  # projection from Embed to value. None if fuse_qkv
     o_proj: hnn.Linear  # projection from Heads to output
     rotary_emb: LlamaRotaryEmbedding  # rotary embedding
+    # projection from Embed to (query, key, value), grouped by kv head. Only if fuse_qkv
+    qkv_proj: Optional[hnn.Linear] = None
 
     @staticmethod
     def init(config: LlamaConfig, *, key) -> "LlamaAttention":
@@ -279,23 +316,49 @@ class LlamaAttention(StateDictSerializationMixin, eqx.Module):
         QHeadsPerGroup = hax.Axis("q_heads_per_group", config.num_heads // config.num_kv_heads)
 
         k_q, k_k, k_v, k_o = jrandom.split(key, 4)
+        o_proj = hnn.Linear.init(In=(config.Heads, config.HeadSize), Out=Embed, key=k_o, use_bias=use_bias)
+        rotary_emb = LlamaRotaryEmbedding(config.HeadSize, config.Pos)
+
+        if config.fuse_qkv:
+            # each kv head gets its group of query heads, followed by its key and value heads
+            QKVPerGroup = hax.Axis("qkv_per_group", QHeadsPerGroup.size + 2)
+            qkv_proj = hnn.Linear.init(
+                In=Embed,
+                Out=(config.KVHeads, QKVPerGroup, config.HeadSize),
+                key=k_q,
+                use_bias=use_bias,
+                out_first=True,
+            )
+            return LlamaAttention(config, None, None, None, o_proj, rotary_emb, qkv_proj)
+
         q_proj = hnn.Linear.init(
             In=Embed, Out=(config.KVHeads, QHeadsPerGroup, config.HeadSize), key=k_q, use_bias=use_bias
         )
         k_proj = hnn.Linear.init(In=Embed, Out=(config.KVHeads, config.HeadSize), key=k_k, use_bias=use_bias)
         v_proj = hnn.Linear.init(In=Embed, Out=(config.KVHeads, config.HeadSize), key=k_v, use_bias=use_bias)
-        o_proj = hnn.Linear.init(In=(config.Heads, config.HeadSize), Out=Embed, key=k_o, use_bias=use_bias)
-        rotary_emb = LlamaRotaryEmbedding(config.HeadSize, config.Pos)
         return LlamaAttention(config, q_proj, k_proj, v_proj, o_proj, rotary_emb)
 
     @named_call
     def __call__(self, x: NamedArray, mask: Optional[NamedArray], *, key=None) -> NamedArray:
         key_q, key_k, key_v, key_o = maybe_rng_split(key, 4)
 
+        if self.qkv_proj is not None:
+            qkv = self.qkv_proj(x, key=key_q)
+            QKVPerGroup = qkv.resolve_axis("qkv_per_group")
+            q_heads_per_group = QKVPerGroup.size - 2
+            q = qkv[QKVPerGroup, :q_heads_per_group].rename({"qkv_per_group": "q_heads_per_group"})
+            k = qkv[QKVPerGroup, q_heads_per_group]
+            v = qkv[QKVPerGroup, q_heads_per_group + 1]
+        else:
+            assert self.q_proj is not None and self.k_proj is not None and self.v_proj is not None
+            q = self.q_proj(x, key=key_q)
+            k = self.k_proj(x, key=key_k)
+            v = self.v_proj(x, key=key_v)
+
         # reorder heads and position for better training throughput
-        q = self.q_proj(x, key=key_q).rearrange((..., "kv_heads", "q_heads_per_group", "position", "head_size"))
-        k = self.k_proj(x, key=key_k).rearrange((..., "kv_heads", "position", "head_size"))
-        v = self.v_proj(x, key=key_v).rearrange((..., "kv_heads", "position", "head_size"))
+        q = q.rearrange((..., "kv_heads", "q_heads_per_group", "position", "head_size"))
+        k = k.rearrange((..., "kv_heads", "position", "head_size"))
+        v = v.rearrange((..., "kv_heads", "position", "head_size"))
 
         cos, sin = self.rotary_emb(seq_len=x.axis_size("position"))
 
@@ -332,9 +395,12 @@ class LlamaAttention(StateDictSerializationMixin, eqx.Module):
     def from_state_dict(self, state_dict: StateDict, prefix: Optional[str] = None):
         # unflatten the linear layers of HF state_dict to match the shape of LlamaAttention
         d = {}
-        d.update(unflatten_linear_layers(apply_prefix(prefix, "q_proj"), state_dict, self.q_proj, True))
-        d.update(unflatten_linear_layers(apply_prefix(prefix, "k_proj"), state_dict, self.k_proj, True))
-        d.update(unflatten_linear_layers(apply_prefix(prefix, "v_proj"), state_dict, self.v_proj, True))
+        if self.qkv_proj is not None:
+            d.update(self._fuse_qkv_state_dict(state_dict, prefix))
+        else:
+            d.update(unflatten_linear_layers(apply_prefix(prefix, "q_proj"), state_dict, self.q_proj, True))
+            d.update(unflatten_linear_layers(apply_prefix(prefix, "k_proj"), state_dict, self.k_proj, True))
+            d.update(unflatten_linear_layers(apply_prefix(prefix, "v_proj"), state_dict, self.v_proj, True))
         d.update(unflatten_linear_layers(apply_prefix(prefix, "o_proj"), state_dict, self.o_proj, True))
 
         return super().from_state_dict(d, prefix)
@@ -344,14 +410,79 @@ class LlamaAttention(StateDictSerializationMixin, eqx.Module):
         my_dict: StateDict = {}
         super().update_state_dict(my_dict, prefix)
 
-        my_dict.update(flatten_linear_layers(apply_prefix(prefix, "q_proj"), self.q_proj, True))
-        my_dict.update(flatten_linear_layers(apply_prefix(prefix, "k_proj"), self.k_proj, True))
-        my_dict.update(flatten_linear_layers(apply_prefix(prefix, "v_proj"), self.v_proj, True))
+        if self.qkv_proj is not None:
+            if not isinstance(self.qkv_proj, hnn.Linear):
+                # e.g. a LoRA adapter on qkv_proj, which has no HF equivalent
+                raise NotImplementedError(
+                    f"Can't serialize a fused qkv_proj of type {type(self.qkv_proj).__name__}. Use fuse_qkv=False."
+                )
+            # HF checkpoints store q, k, and v separately
+            my_dict.pop(apply_prefix(prefix, "qkv_proj.weight"), None)
+            my_dict.pop(apply_prefix(prefix, "qkv_proj.bias"), None)
+            my_dict.update(self._split_qkv_state_dict(prefix))
+        else:
+            my_dict.update(flatten_linear_layers(apply_prefix(prefix, "q_proj"), self.q_proj, True))
+            my_dict.update(flatten_linear_layers(apply_prefix(prefix, "k_proj"), self.k_proj, True))
+            my_dict.update(flatten_linear_layers(apply_prefix(prefix, "v_proj"), self.v_proj, True))
         my_dict.update(flatten_linear_layers(apply_prefix(prefix, "o_proj"), self.o_proj, True))
 
         state_dict.update(my_dict)
         return state_dict
 
+    def _fuse_qkv_state_dict(self, state_dict: StateDict, prefix: Optional[str]) -> StateDict:
+        """Concatenates the flattened q_proj, k_proj, and v_proj of an HF state dict into our qkv_proj"""
+        assert self.qkv_proj is not None
+        KVHeads, HeadSize = self.config.KVHeads, self.config.HeadSize
+        q_heads_per_group = self.config.num_heads // self.config.num_kv_heads
+        QKVPerGroup = hax.Axis("qkv_per_group", q_heads_per_group + 2)
+        # e.g. the layer axis, if we're stacked
+        assert self.qkv_proj.weight is not None
+        own_axes = {KVHeads.name, QKVPerGroup.name, HeadSize.name, self.config.Embed.name}
+        extra_dims = tuple(ax for ax in self.qkv_proj.weight.axes if ax.name not in own_axes)
+
+        ret_dict: StateDict = {}
+        for param in ["weight", "bias"]:
+            parts = []
+            for name, heads_per_group in [("q_proj", q_heads_per_group), ("k_proj", 1), ("v_proj", 1)]:
+                key = apply_prefix(prefix, f"{name}.{param}")
+                if key not in state_dict:
+                    break
+                axes = extra_dims + (("__OUT__", self.config.Embed) if param == "weight" else ("__OUT__",))
+                part = hax.named(state_dict[key], axes)
+                Group = QKVPerGroup.resize(heads_per_group)
+                parts.append(part.unflatten_axis("__OUT__", (KVHeads, Group, HeadSize)))
+            else:
+                qkv = hax.concatenate(QKVPerGroup, parts)
+                target = self.qkv_proj.weight if param == "weight" else self.qkv_proj.bias
+                assert target is not None
+                ret_dict[apply_prefix(prefix, f"qkv_proj.{param}")] = qkv.rearrange(target.axes).array
+
+        return ret_dict
+
+    def _split_qkv_state_dict(self, prefix: Optional[str]) -> StateDict:
+        """Splits our qkv_proj into flattened q_proj, k_proj, and v_proj, as stored in HF checkpoints"""
+        assert self.qkv_proj is not None
+        q_heads_per_group = self.config.num_heads // self.config.num_kv_heads
+        QKVPerGroup = hax.Axis("qkv_per_group", q_heads_per_group + 2)
+        slices = {
+            "q_proj": slice(0, q_heads_per_group),
+            "k_proj": slice(q_heads_per_group, q_heads_per_group + 1),
+            "v_proj": slice(q_heads_per_group + 1, q_heads_per_group + 2),
+        }
+
+        # weights may have been filtered out, e.g. when only saving LoRA parameters
+        ret_dict: StateDict = {}
+        for name, sl in slices.items():
+            for param, value in [("weight", self.qkv_proj.weight), ("bias", self.qkv_proj.bias)]:
+                if value is None:
+                    continue
+                value = value[QKVPerGroup, sl].flatten_axes(("kv_heads", "qkv_per_group", "head_size"), "__OUT__")
+                if param == "weight":
+                    value = value.rearrange((..., "__OUT__", "embed"))
+                ret_dict[apply_prefix(prefix, f"{name}.{param}")] = value.array
+
+        return ret_dict
+
 
 class LlamaRMSNorm(hnn.LayerNorm):
     """It is a modified version of LayerNorm.
@@ -378,6 +509,9 @@ class LlamaRMSNorm(hnn.LayerNorm):
     def __call__(self, x: NamedArray) -> NamedArray:
         # This gives a different result than jnp.var(), which is
         # defined as the average of the squared deviations from the mean
+        # compute the statistics in float32 even if the activations are in lower precision
+        in_dtype = x.dtype
+        x = x.astype(jnp.float32)
         var = hax.mean(hax.square(x), axis=self.axis)
         inv = hax.rsqrt(var + self.eps)
         out = x * inv
@@ -386,7 +520,7 @@ class LlamaRMSNorm(hnn.LayerNorm):
             out = self.weight * out
         if self.bias is not None:
             out = out + self.bias
-        return out
+        return out.astype(in_dtype)
 
 
 class LlamaDecoderLayer(StateDictSerializationMixin, eqx.Module):
@@ -446,9 +580,26 @@ class LlamaTransformer(StateDictSerializationMixin, eqx.Module):
         return LlamaTransformer(config, layers, ln_f)
 
     @named_call
-    def __call__(self, x: NamedArray, attn_mask: Optional[NamedArray], *, key) -> NamedArray:
+    def __call__(self, x: NamedArray, attn_mask: Optional[NamedArray], *, key, inference: bool = False) -> NamedArray:
+        """
+        Args:
+            inference: if True, nothing is going to be differentiated, so the layers are scanned without any
+                checkpointing regardless of `gradient_checkpointing`.
+        """
         keys = maybe_rng_split(key, self.config.num_layers) if key is not None else None
-        x = self.layers.fold(x, mask=attn_mask, key=keys)
+        if inference:
+            x = hax.fold(lambda x, layer, k: layer(x, attn_mask, key=k), self.layers.Block)(
+                x, self.layers.stacked, keys
+            )
+        elif self.config.gradient_checkpointing and self.config.checkpoint_segment_size > 1:
+            policy_name = self.config.gradient_checkpointing_policy
+            policy = getattr(jax.checkpoint_policies, policy_name) if policy_name is not None else None
+            x = _fold_in_checkpointed_segments(
+                self.layers, x, attn_mask, keys, segment_size=self.config.checkpoint_segment_size, policy=policy
+            )
+        else:
+            # per-layer checkpointing (if enabled) is handled by Stacked
+            x = self.layers.fold(x, mask=attn_mask, key=keys)
         x = self.norm(x)
 
         return x
@@ -521,10 +672,10 @@ class LlamaLMHeadModel(eqx.Module, LmHeadModel[LlamaConfig], StateDictSerializat
 
     @classmethod
     def init(cls, Vocab: Axis, config: LlamaConfig, *, key) -> "LlamaLMHeadModel":
-        k_t, k_emb = jrandom.split(key, 2)
+        k_t, k_emb, k_head = jrandom.split(key, 3)
         transformer = LlamaTransformer.init(config, key=k_t)
         embeddings = LlamaEmbedding.init(Vocab, config, key=k_emb)
-        lm_head = hnn.Linear.init(In=config.Embed, Out=Vocab, key=k_emb, use_bias=False, out_first=True)
+        lm_head = hnn.Linear.init(In=config.Embed, Out=Vocab, key=k_head, use_bias=False, out_first=True)
         return LlamaLMHeadModel(transformer, embeddings, lm_head)
 
     def __call__(
@@ -582,6 +733,55 @@ class LlamaLMHeadModel(eqx.Module, LmHeadModel[LlamaConfig], StateDictSerializat
         return state_dict
 
 
+def _fold_in_checkpointed_segments(
+    layers: Stacked[LlamaDecoderLayer],
+    x: NamedArray,
+    attn_mask: Optional[NamedArray | AttentionMask],
+    keys,
+    *,
+    segment_size: int,
+    policy: Optional[Callable],
+) -> NamedArray:
+    """
+    Applies the stacked layers to x, checkpointing in segments of `segment_size` layers. Only the input to each
+    segment is saved in the forward pass. In the backward pass each segment is recomputed once. During that
+    recomputation each layer saves all of its activations if `policy` is None, or whatever `policy` allows otherwise.
+
+    The scan over segments is rolled, so the traced program only contains one segment. The scan over the layers in a
+    segment is fully unrolled, so XLA can fuse across the layers of a segment.
+    """
+    Layers = layers.Block
+    Segments = Axis("segments", Layers.size // segment_size)
+    SegmentLayers = Layers.resize(segment_size)
+
+    def _split_layers(a):
+        if isinstance(a, NamedArray):
+            return a.unflatten_axis(Layers, (Segments, SegmentLayers))
+        elif is_jax_array_like(a):
+            return a.reshape((Segments.size, SegmentLayers.size) + a.shape[1:])
+        else:
+            return a
+
+    segments = jax.tree_util.tree_map(_split_layers, layers.stacked, is_leaf=lambda a: isinstance(a, NamedArray))
+    if keys is not None:
+        keys = _split_layers(keys)
+
+    def do_layer(x, layer, key):
+        return layer(x, attn_mask, key=key)
+
+    # Without a policy, the layers inside a segment aren't checkpointed at all: the segment's recompute keeps every
+    # activation, so each layer's forward runs twice in total, the same as per-layer remat. With a policy, each layer
+    # is checkpointed too, and only saves what the policy allows during that recompute.
+    if policy is not None:
+        do_layer = functools.partial(jax.checkpoint, policy=policy, prevent_cse=False)(do_layer)
+
+    @functools.partial(jax.checkpoint, prevent_cse=False)
+    def do_segment(x, segment, segment_keys):
+        return hax.fold(do_layer, SegmentLayers, unroll=SegmentLayers.size)(x, segment, segment_keys)
+
+    return hax.fold(do_segment, Segments)(x, segments, keys)
+
+
 def _rotate_half(x: NamedArray) -> NamedArray:
     """Rotates half of the hidden dims of the input and concatenates them."""
     HeadSize = x.axes[-1]
@@ -1,5 +1,7 @@
+import functools
 from typing import Optional
 
+import jax
 import jax.numpy as jnp
 
 import haliax as hax
@@ -40,3 +42,61 @@ def cross_entropy_and_logsumexp_penalty(
     loss, log_normalizers = cross_entropy_loss_and_log_normalizers(pred_y, Vocab, target_y)
 
     return loss + logsumexp_weight * (log_normalizers**2)
+
+
+def fused_lm_head_cross_entropy(
+    Pos: hax.AxisSelector,
+    Embed: hax.AxisSelector,
+    Vocab: hax.Axis,
+    x: NamedArray,
+    lm_head: NamedArray,
+    targets: NamedArray,
+    *,
+    block_size: int = 512,
+) -> NamedArray:
+    """
+    Computes the per-token cross entropy of `x @ lm_head` against `targets` without materializing the full
+    [..., Pos, Vocab] logits. The sequence is split into blocks of `block_size` positions, and the logits for each
+    block are computed, reduced, and discarded. The blocks are rematerialized in the backward pass rather than saved.
+
+    Args:
+        Pos: axis of the sequence
+        Embed: axis that x and lm_head are contracted over
+        Vocab: vocabulary axis of lm_head
+        x: [..., Pos, Embed] hidden states
+        lm_head: [Vocab, Embed] output projection
+        targets: [..., Pos] integer ids of the target tokens
+        block_size: number of positions per block. If Pos isn't a multiple of it, the sequence is padded to one and
+            the padded positions are dropped from the result.
+
+    Returns:
+        NamedArray of shape targets.axes with the unreduced loss for each position
+    """
+    Pos = x.resolve_axis(Pos)
+    block_size = min(block_size, Pos.size)
+    num_blocks = -(-Pos.size // block_size)
+    PaddedPos = Pos.resize(num_blocks * block_size)
+    Block = hax.Axis("__loss_block__", num_blocks)
+    PosBlock = Pos.resize(block_size)
+
+    def pad(a: NamedArray) -> NamedArray:
+        if PaddedPos.size == Pos.size:
+            return a
+        padding = [(0, PaddedPos.size - Pos.size) if ax == Pos else (0, 0) for ax in a.axes]
+        return hax.named(jnp.pad(a.array, padding), tuple(PaddedPos if ax == Pos else ax for ax in a.axes))
+
+    @functools.partial(jax.checkpoint, policy=jax.checkpoint_policies.nothing_saveable)
+    def block_loss(x_b: NamedArray, targets_b: NamedArray) -> NamedArray:
+        # only one block of logits is live at a time, so the softmax can afford to be in full precision
+        logits = hax.dot(Embed, x_b, lm_head).astype(jnp.float32)
+        log_normalizers = hax.nn.logsumexp(logits, Vocab)
+        target_logits = hax.sum(logits * hax.nn.one_hot(targets_b, Vocab, dtype=logits.dtype), axis=Vocab)
+        return log_normalizers - target_logits
+
+    loss = hax.map(block_loss, Block)(
+        pad(x).unflatten_axis(Pos.name, (Block, PosBlock)), pad(targets).unflatten_axis(Pos.name, (Block, PosBlock))
+    )
+
+    # the padded positions are zeros (and target id 0). Slicing them off also drops them from the gradient
+    loss = loss.flatten_axes((Block, PosBlock), PaddedPos)[PaddedPos, : Pos.size]
+    return loss.rearrange(targets.axes)
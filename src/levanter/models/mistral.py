@@ -1,16 +1,22 @@
+import collections
+import copy
 import dataclasses
+import functools
 from dataclasses import dataclass
-from typing import Dict, Optional, Type, Union
+from typing import ClassVar, Dict, Optional, Tuple, Type, Union
 
 import equinox as eqx
+import jax
 import jax.random as jrandom
+import numpy as np
 
 import haliax as hax
 import haliax.nn as hnn
 from haliax import Axis, NamedArray
 from haliax.jax_utils import maybe_rng_split
+from haliax.nn.attention import combine_masks_and
 
-from levanter.compat.hf_checkpoints import HFCheckpointConverter
+from levanter.compat.hf_checkpoints import HFCheckpointConverter, load_tokenizer_with_local_cache
 from levanter.compat.torch_serialization import (
     StateDict,
     StateDictSerializationMixin,
@@ -19,9 +25,10 @@ from levanter.compat.torch_serialization import (
     unflatten_linear_layers,
 )
 from levanter.logging import silence_transformer_nag
-from levanter.models.attention import AttentionMask
+from levanter.models.attention import AttentionMask, sliding_window_mask
 from levanter.models.llama import LlamaConfig, LlamaEmbedding, LlamaTransformer
-from levanter.models.lm_model import LmConfig, LmHeadModel
+from levanter.models.lm_model import LmConfig, LmExample, LmHeadModel
+from levanter.models.loss import fused_lm_head_cross_entropy
 from levanter.utils.py_utils import cached_classproperty
 
 
@@ -46,6 +53,19 @@ class MistralConfig(LlamaConfig):
             Note that num_heads must be divisible by this number. Defaults to 8.
         activation_function (str, optional): activation function for the hidden layer. Defaults to "silu".
         sliding_window (int, optional): window size of sliding window attention. Defaults to 4096.
+        use_flash_attention (bool, optional): whether to use flash attention. Blocks of the attention matrix that fall
+            entirely outside the causal sliding window are skipped. Defaults to True.
+        flash_attention_block_size (int, optional): block size for flash attention. Sequences whose length isn't a
+            multiple of it fall back to regular attention. Defaults to 128.
+        gradient_checkpointing_block_size (int, optional): number of layers per gradient checkpointing segment.
+            Defaults to None, meaning ~sqrt(num_layers).
+        gradient_checkpointing_policy (str, optional): `jax.checkpoint_policies` policy used inside a segment while it
+            is recomputed. Defaults to "dots_with_no_batch_dims_saveable", which keeps the projection outputs but
+            recomputes the attention scores.
+        fuse_qkv (bool, optional): whether to compute the query, key and value projections with a single matmul.
+            LoRA can't target the fused projection. Defaults to False.
+        tie_word_embeddings (bool, optional): whether to use the token embeddings as the output projection instead
+            of a separate lm_head. Defaults to False.
     """
 
     seq_len: int = 8192
@@ -61,64 +81,80 @@ class MistralConfig(LlamaConfig):
 
     # Attention-related config
     upcast_attn: bool = False
-    use_flash_attention: bool = False
-    flash_attention_block_size: Optional[int] = None
+    use_flash_attention: bool = True
+    flash_attention_block_size: Optional[int] = 128
+    fuse_qkv: bool = False
 
     gradient_checkpointing: bool = True
-    gradient_checkpointing_block_size: int = 5
+    gradient_checkpointing_block_size: Optional[int] = None
+    gradient_checkpointing_policy: Optional[str] = "dots_with_no_batch_dims_saveable"
 
     use_bias: bool = False
     rope_scaling: Optional[dict] = None
-
-    # Axis
-    Pos = property(lambda self: Axis(name="position", size=self.seq_len))
-    KeyPos = property(lambda self: self.Pos.alias("key_position"))
-    Embed = property(lambda self: Axis(name="embed", size=self.hidden_dim))
-    Heads = property(lambda self: Axis(name="heads", size=self.num_heads))
-    KVHeads = property(lambda self: Axis(name="kv_heads", size=self.num_kv_heads))
-    Layers = property(lambda self: Axis(name="layers", size=self.num_layers))
-    Mlp = property(lambda self: Axis(name="mlp", size=self.intermediate_dim))
-    HeadSize = property(lambda self: Axis(name="head_size", size=self.hidden_dim // self.num_heads))
+    tie_word_embeddings: bool = False
+
+    # Axis. The config is frozen, so these are built once in __post_init__ rather than on every access.
+    _axes: ClassVar[Dict[str, Axis]]
+    Pos = property(lambda self: self._axes["Pos"])
+    KeyPos = property(lambda self: self._axes["KeyPos"])
+    Embed = property(lambda self: self._axes["Embed"])
+    Heads = property(lambda self: self._axes["Heads"])
+    KVHeads = property(lambda self: self._axes["KVHeads"])
+    Layers = property(lambda self: self._axes["Layers"])
+    Mlp = property(lambda self: self._axes["Mlp"])
+    HeadSize = property(lambda self: self._axes["HeadSize"])
+
+    def __post_init__(self):
+        super().__post_init__()
+        Pos = Axis(name="position", size=self.seq_len)
+        axes = {
+            "Pos": Pos,
+            "KeyPos": Pos.alias("key_position"),
+            "Embed": Axis(name="embed", size=self.hidden_dim),
+            "Heads": Axis(name="heads", size=self.num_heads),
+            "KVHeads": Axis(name="kv_heads", size=self.num_kv_heads),
+            "Layers": Axis(name="layers", size=self.num_layers),
+            "Mlp": Axis(name="mlp", size=self.intermediate_dim),
+            "HeadSize": Axis(name="head_size", size=self.hidden_dim // self.num_heads),
+        }
+        object.__setattr__(self, "_axes", axes)
 
     @cached_classproperty
     def default_hf_checkpoint_converter(cls) -> HFCheckpointConverter["MistralConfig"]:  # type: ignore
+        # the tokenizer is the only thing the converter fetches eagerly, so serve it from a local cache when we can
         return HFCheckpointConverter(
             cls,  # type: ignore
             "mistralai/Mistral-7B-v0.1",
             trust_remote_code=True,
-            tokenizer="mistralai/Mistral-7B-v0.1",
+            tokenizer=load_tokenizer_with_local_cache("mistralai/Mistral-7B-v0.1"),
             HfConfigClass=HfMistralConfig,
         )
 
     @classmethod
     def from_hf_config(cls, hf_config: HfConfig):
+        return cls.from_hf_dict(hf_config.to_dict())
+
+    @classmethod
+    def from_hf_dict(cls, hf_dict: Dict) -> "MistralConfig":
+        """Like `from_hf_config`, but reads a plain dict (e.g. a parsed config.json) without going through
+        transformers. Optional keys that are missing take HF's defaults, which match ours."""
         return MistralConfig(
-            seq_len=hf_config.max_position_embeddings,  # this might be too big...
-            hidden_dim=hf_config.hidden_size,
-            intermediate_dim=hf_config.intermediate_size,
-            num_layers=hf_config.num_hidden_layers,
-            num_heads=hf_config.num_attention_heads,
-            num_kv_heads=hf_config.num_key_value_heads,
-            activation_function=hf_config.hidden_act,
-            initializer_range=hf_config.initializer_range,
-            layer_norm_epsilon=hf_config.rms_norm_eps,
-            sliding_window=hf_config.sliding_window,
+            seq_len=hf_dict["max_position_embeddings"],  # this might be too big...
+            hidden_dim=hf_dict["hidden_size"],
+            intermediate_dim=hf_dict["intermediate_size"],
+            num_layers=hf_dict["num_hidden_layers"],
+            num_heads=hf_dict["num_attention_heads"],
+            num_kv_heads=hf_dict["num_key_value_heads"],
+            activation_function=hf_dict.get("hidden_act", "silu"),
+            initializer_range=hf_dict.get("initializer_range", 0.02),
+            layer_norm_epsilon=hf_dict.get("rms_norm_eps", 1e-6),
+            sliding_window=hf_dict.get("sliding_window", 4096),
+            tie_word_embeddings=hf_dict.get("tie_word_embeddings", False),
         )
 
-    def to_hf_config(self, vocab_size: int, config_overrides: Optional[Dict] = None) -> HfMistralConfig:
-        """Convert to HuggingFace's MistralConfig
-
-        Args:
-            vocab_size (int, optional): Vocabulary size of the tokenizer. Defaults to 32000.
-            config_overrides (dict, optional): Overrides for the config. Defaults to None.
-
-        Returns:
-            HfMistralConfig: HuggingFace's MistralConfig
-        """
-        if config_overrides is None:
-            config_overrides = {}
-
-        return HfMistralConfig(
+    def to_hf_dict(self) -> Dict:
+        """The HF MistralConfig kwargs for this config, except for vocab_size, as a plain dict"""
+        return dict(
             max_position_embeddings=self.seq_len,
             hidden_size=self.hidden_dim,
             intermediate_size=self.intermediate_dim,
@@ -129,19 +165,49 @@ class MistralConfig(LlamaConfig):
             initializer_range=self.initializer_range,
             rms_norm_eps=self.layer_norm_epsilon,
             sliding_window=self.sliding_window,
-            vocab_size=vocab_size,
-            **config_overrides,
+            tie_word_embeddings=self.tie_word_embeddings,
         )
 
+    def to_hf_config(self, vocab_size: int, config_overrides: Optional[Dict] = None) -> HfMistralConfig:
+        """Convert to HuggingFace's MistralConfig
+
+        Args:
+            vocab_size (int, optional): Vocabulary size of the tokenizer. Defaults to 32000.
+            config_overrides (dict, optional): Overrides for the config. Defaults to None.
+
+        Returns:
+            HfMistralConfig: HuggingFace's MistralConfig
+        """
+        overrides_key = tuple(sorted((config_overrides or {}).items()))
+        try:
+            hash((self, vocab_size, overrides_key))
+        except TypeError:
+            # something isn't hashable (e.g. a list of architectures in the overrides), so we can't cache it
+            return self._build_hf_config(vocab_size, config_overrides or {})
+
+        hf_config = _cached_hf_config(self, vocab_size, overrides_key)
+
+        # the cached config is shared, so callers get their own copy to mutate
+        return copy.deepcopy(hf_config)
+
+    def _build_hf_config(self, vocab_size: int, config_overrides: Dict) -> HfMistralConfig:
+        return HfMistralConfig(**self.to_hf_dict(), vocab_size=vocab_size, **config_overrides)
+
     @property
     def model_type(cls) -> Type["MistralLMHeadModel"]:
         return MistralLMHeadModel
 
 
+# The config (and the Axis objects it holds) is treated as static metadata rather than as a leaf: it has no children,
+# so jax.jit and friends hash it into the treedef instead of trying to trace it. This is jax.tree_util.register_static,
+# which isn't available in all the jax versions we support.
+jax.tree_util.register_pytree_node(MistralConfig, lambda config: ((), config), lambda config, _: config)
+
+
 class MistralLMHeadModel(eqx.Module, LmHeadModel[MistralConfig], StateDictSerializationMixin):
     transformer: LlamaTransformer
     embeddings: LlamaEmbedding
-    lm_head: hnn.Linear
+    lm_head: Optional[hnn.Linear]  # None if the word embeddings are tied
 
     @property
     def config(self):
@@ -157,10 +223,18 @@ class MistralLMHeadModel(eqx.Module, LmHeadModel[MistralConfig], StateDictSerial
 
     @classmethod
     def init(cls, Vocab: Axis, config: MistralConfig, *, key) -> "MistralLMHeadModel":
-        k_t, k_emb = jrandom.split(key, 2)
+        k_t, k_emb, k_head = jrandom.split(key, 3)
         transformer = LlamaTransformer.init(config, key=k_t)
         embeddings = LlamaEmbedding.init(Vocab, config, key=k_emb)
-        lm_head = hnn.Linear.init(In=config.Embed, Out=Vocab, key=k_emb, use_bias=False, out_first=True)
+        if config.tie_word_embeddings:
+            # the embeddings are initialized with std 1, which would make the initial logits ~sqrt(hidden_dim) times
+            # too large as an output projection. Scale them like gpt2 does for its (always tied) embeddings.
+            embeddings = eqx.tree_at(
+                lambda e: e.token_embeddings, embeddings, embeddings.token_embeddings * config.initializer_range
+            )
+            lm_head = None
+        else:
+            lm_head = hnn.Linear.init(In=config.Embed, Out=Vocab, key=k_head, use_bias=False, out_first=True)
         return MistralLMHeadModel(transformer, embeddings, lm_head)
 
     def __call__(
@@ -169,6 +243,8 @@ class MistralLMHeadModel(eqx.Module, LmHeadModel[MistralConfig], StateDictSerial
         attn_mask: Optional[Union[NamedArray, AttentionMask]] = None,
         *,
         key=None,
+        deterministic: bool = False,
+        inference: bool = False,
     ) -> NamedArray:
         """
         Args:
@@ -177,42 +253,165 @@ class MistralLMHeadModel(eqx.Module, LmHeadModel[MistralConfig], StateDictSerial
             attn_mask (Union[NamedArray, AttentionMask], optional): [batch, position]
                 Mask to avoid performing attention on the padding token indices of the encoder input.
                 The attn_mask from training pipeline may be an AttentionMask object instead of NamedArray
+            deterministic (bool, optional): if True, `key` is ignored and no keys are split. This is a Python bool,
+                so it's static under jit.
+            inference (bool, optional): if True, the layers are scanned without gradient checkpointing, so the
+                result shouldn't be differentiated. Also static under jit.
         """
+        if deterministic:
+            key = None
         k_t, k_head = maybe_rng_split(key, 2)
-        x = self.embeddings.embed(input_ids)
-        x = self.transformer(x, attn_mask=attn_mask, key=k_t)
-        lm_logits = self.lm_head(x, key=k_head)
+        x = self._hidden_states(input_ids, attn_mask, key=k_t, inference=inference)
+        if self.lm_head is not None and not isinstance(self.lm_head, hnn.Linear):
+            # a wrapped lm_head (e.g. LoRA) has to be called for the wrapper to apply, so we can't pin its layout
+            return self.lm_head(x, key=k_head)
+
+        lm_logits = hax.dot(self.config.Embed, x, self._lm_head_weight())
         return lm_logits
 
+    @classmethod
+    def jit_step(
+        cls,
+        model: "MistralLMHeadModel",
+        input_ids: NamedArray,
+        attn_mask: Optional[Union[NamedArray, AttentionMask]] = None,
+    ) -> NamedArray:
+        """
+        Jitted version of `model(input_ids, attn_mask)`. The compiled function is specialized to the shapes and
+        dtypes of the inputs (and to the static structure of the mask, like causality and the sliding window), and
+        one compilation is kept per distinct signature, so e.g. alternating between prefill and decode shapes doesn't
+        retrace either.
+        """
+        return _jit_forward(model, input_ids, attn_mask)
+
+    def compute_loss(
+        self,
+        example: LmExample,
+        *,
+        key=None,
+        reduction: Optional[hax.ReductionFunction] = hax.mean,
+        reduction_axis: Optional[hax.AxisSelection] = None,
+    ) -> NamedArray:
+        """
+        Same as [LmHeadModel.compute_loss][], but fuses the lm_head projection with the cross-entropy so that the
+        [batch, position, vocab] logits are never materialized.
+
+        If lm_head has been wrapped (e.g. by LoRA), this falls back to [LmHeadModel.compute_loss][] so that the
+        wrapper is applied.
+        """
+        if self.lm_head is not None and not isinstance(self.lm_head, hnn.Linear):
+            return LmHeadModel.compute_loss(self, example, key=key, reduction=reduction, reduction_axis=reduction_axis)
+
+        x = self._hidden_states(example.tokens, example.attn_mask, key=key)
+
+        targets = hax.roll(example.tokens, -1, axis=self.Pos.name)
+        loss = fused_lm_head_cross_entropy(
+            self.Pos.name, self.config.Embed, self.Vocab, x, self._lm_head_weight(), targets
+        )
+
+        if reduction is None:
+            return hax.where(example.loss_mask, loss, 0)
+
+        return reduction(loss, where=example.loss_mask, axis=reduction_axis)
+
+    def _lm_head_weight(self) -> NamedArray:
+        """
+        The [vocab, embed] output projection (the token embeddings if they're tied), kept vocab major so that XLA
+        doesn't transpose it into the fusions around the logits matmul. It's constrained to the sharding of whatever
+        axis mapping is active, which inside the trainer's loss is the compute mapping, not the parameter mapping.
+        """
+        if self.lm_head is None:
+            weight = self.embeddings.token_embeddings
+        else:
+            weight = self.lm_head.weight
+
+        return hax.auto_sharded(weight.rearrange((self.Vocab, self.config.Embed)))
+
+    def _hidden_states(
+        self,
+        input_ids: NamedArray,
+        attn_mask: Optional[Union[NamedArray, AttentionMask]],
+        *,
+        key,
+        inference: bool = False,
+    ) -> NamedArray:
+        attn_mask = self._apply_sliding_window(input_ids, attn_mask)
+        x = self.embeddings.embed(input_ids)
+        return self.transformer(x, attn_mask=attn_mask, key=key, inference=inference)
+
+    def _apply_sliding_window(
+        self, input_ids: NamedArray, attn_mask: Optional[Union[NamedArray, AttentionMask]]
+    ) -> Optional[Union[NamedArray, AttentionMask]]:
+        """Restricts attention to the sliding window. For an AttentionMask, flash attention can skip masked blocks."""
+        sliding_window = self.config.sliding_window
+        Pos = input_ids.resolve_axis(self.config.Pos.name)
+        if attn_mask is None or sliding_window is None or sliding_window >= Pos.size:
+            return attn_mask
+
+        if isinstance(attn_mask, AttentionMask):
+            return attn_mask.with_sliding_window(sliding_window)
+
+        window_mask = sliding_window_mask(Pos, Pos.alias(self.config.KeyPos.name), sliding_window)
+        return combine_masks_and(attn_mask, window_mask)
+
     def resize_vocab(self, new_size: int, key=None) -> "LmHeadModel[MistralConfig]":
+        # resize_axis always builds new arrays, so don't touch the weights (or retrace) if there's nothing to do
+        if new_size == self.vocab_size:
+            return self
+
         new_Vocab = self.Vocab.resize(new_size)
         k1, k2 = maybe_rng_split(key, 2)
         new_embeddings = self.embeddings.resize_embeddings(new_size, key=k1)
+        if self.lm_head is None:
+            return eqx.tree_at(lambda m: m.embeddings, self, new_embeddings)
+
         new_lm_matrix = hax.tree_util.resize_axis(self.lm_head.weight, self.Vocab, new_size, key=k2)
+        # Out is a static field, which tree_at can't reach, so the (small) Linear itself is rebuilt
         new_lm_head = dataclasses.replace(self.lm_head, Out=new_Vocab, weight=new_lm_matrix)
 
-        return dataclasses.replace(self, embeddings=new_embeddings, lm_head=new_lm_head)
+        return eqx.tree_at(lambda m: (m.embeddings, m.lm_head), self, (new_embeddings, new_lm_head))
 
     def _state_dict_key_map(self) -> Dict[str, Optional[str]]:
         return {"transformer": "model", "embeddings": None}
 
     def from_state_dict(self, state_dict: StateDict, prefix: Optional[str] = None):
+        if self.lm_head is None:
+            return super().from_state_dict(state_dict, prefix)
+
         # unflatten the linear layers of HF state_dict to match the shape of MistralMlp
-        d = state_dict.copy()
-        d.update(
+        # the ChainMap overlays the unflattened lm_head on the state dict without copying all of its entries
+        lm_head_key = apply_prefix(prefix, "lm_head.weight")
+        lm_head_dict = {lm_head_key: state_dict[lm_head_key]}
+        # HF's lm_head is already [vocab, embed], but it may arrive as a strided view (e.g. a transposed export).
+        # Make it contiguous once on the host rather than handing XLA a layout it has to transpose on device.
+        if isinstance(lm_head_dict[lm_head_key], np.ndarray):
+            lm_head_dict[lm_head_key] = np.ascontiguousarray(lm_head_dict[lm_head_key])
+
+        d = collections.ChainMap(
             unflatten_linear_layers(
-                apply_prefix(prefix, "lm_head"), state_dict, self.lm_head, out_dims_first_in_dict=True
-            )
+                apply_prefix(prefix, "lm_head"), lm_head_dict, self.lm_head, out_dims_first_in_dict=True
+            ),
+            state_dict,
         )
-        return super().from_state_dict(d, prefix)
+        return super().from_state_dict(d, prefix)  # type: ignore
 
     def update_state_dict(self, state_dict: StateDict, prefix: Optional[str] = None) -> StateDict:
-        my_dict: StateDict = {}
-        super().update_state_dict(my_dict, prefix=prefix)
+        super().update_state_dict(state_dict, prefix=prefix)
 
-        my_dict.update(
-            flatten_linear_layers(apply_prefix(prefix, "lm_head"), self.lm_head, out_dims_first_in_dict=True)
-        )
+        # with tied embeddings, HF doesn't serialize lm_head.weight either
+        if self.lm_head is not None:
+            flatten_linear_layers(
+                apply_prefix(prefix, "lm_head"), self.lm_head, out_dims_first_in_dict=True, out=state_dict
+            )
 
-        state_dict.update(my_dict)
         return state_dict
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_hf_config(config: MistralConfig, vocab_size: int, overrides: Tuple) -> HfMistralConfig:
+    return config._build_hf_config(vocab_size, dict(overrides))
+
+
+@eqx.filter_jit
+def _jit_forward(model: MistralLMHeadModel, input_ids: NamedArray, attn_mask) -> NamedArray:
+    return model(input_ids, attn_mask, deterministic=True, inference=True)
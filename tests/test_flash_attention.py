@@ -45,6 +45,35 @@ def test_flash_attention_causal_mask():
     assert jnp.allclose(hax_out.array, flash_out.array, atol=1e-5, rtol=1e-5)
 
 
+def test_flash_attention_sliding_window():
+    Key = hax.Axis("Key", 8)
+    QPos = hax.Axis("QPos", BLOCK_SIZE * 4)
+    KPos = hax.Axis("KPos", BLOCK_SIZE * 4)
+
+    # deliberately not a multiple of the block size, so some blocks are only partially in the window
+    mask = AttentionMask.causal(sliding_window=BLOCK_SIZE + BLOCK_SIZE // 2)
+
+    q = hax.random.normal(jrandom.PRNGKey(0), (QPos, Key))
+    k = hax.random.normal(jrandom.PRNGKey(1), (KPos, Key))
+    v = hax.random.normal(jrandom.PRNGKey(2), (KPos, Key))
+
+    @equinox.filter_value_and_grad
+    def d_attn(qkv, fn, mask):
+        q, k, v = qkv
+        x_out = fn(KPos, Key, q, k, v, mask=mask)
+        return (x_out * x_out).sum().scalar()
+
+    hax_val, (hax_dq, hax_dk, hax_dv) = d_attn(
+        (q, k, v), hnn.attention.dot_product_attention, mask.materialize(QPos, KPos)
+    )
+    fa_val, (fa_dq, fa_dk, fa_dv) = d_attn((q, k, v), functools.partial(flash_attention, QPos, inference=True), mask)
+
+    assert jnp.allclose(hax_val, fa_val, atol=1e-4, rtol=1e-4)
+    assert jnp.allclose(hax_dq.array, fa_dq.array, atol=1e-4, rtol=1e-4)
+    assert jnp.allclose(hax_dk.array, fa_dk.array, atol=1e-4, rtol=1e-4)
+    assert jnp.allclose(hax_dv.array, fa_dv.array, atol=1e-4, rtol=1e-4)
+
+
 def test_grad_attention():
     Key = hax.Axis("Key", 8)
     QPos = hax.Axis("QPos", BLOCK_SIZE * 2)
@@ -2,7 +2,7 @@ import os
 
 from fsspec import AbstractFileSystem
 
-from levanter.compat.hf_checkpoints import load_tokenizer
+from levanter.compat.hf_checkpoints import load_tokenizer, load_tokenizer_with_local_cache
 
 
 def test_load_tokenizer_in_memory_fs():
@@ -22,3 +22,29 @@ def test_load_tokenizer_in_memory_fs():
         )
     tokenizer = load_tokenizer("memory://foo/")
     assert len(tokenizer) == 5027
+
+
+def test_load_tokenizer_with_local_cache(tmp_path):
+    tokenizer = load_tokenizer_with_local_cache("gpt2", cache_dir=str(tmp_path))
+    # entries are keyed by the commit the revision resolved to
+    (entry,) = [p for p in os.listdir(tmp_path) if not p.endswith(".lock")]
+    assert entry.startswith("gpt2--")
+    commit = entry[len("gpt2--") :]
+
+    cached_tokenizer = load_tokenizer_with_local_cache("gpt2", cache_dir=str(tmp_path))
+    assert len(cached_tokenizer) == len(tokenizer)
+    assert cached_tokenizer("hello world")["input_ids"] == tokenizer("hello world")["input_ids"]
+
+    # a pinned commit hits the same entry
+    pinned_tokenizer = load_tokenizer_with_local_cache("gpt2", revision=commit, cache_dir=str(tmp_path))
+    assert pinned_tokenizer("hello world")["input_ids"] == tokenizer("hello world")["input_ids"]
+    assert [p for p in os.listdir(tmp_path) if not p.endswith(".lock")] == [entry]
+
+
+def test_load_tokenizer_with_local_cache_unwritable(tmp_path):
+    # a cache dir that can't be created, like one under a read-only home
+    not_a_dir = tmp_path / "not_a_dir"
+    not_a_dir.write_text("")
+
+    tokenizer = load_tokenizer_with_local_cache("gpt2", cache_dir=str(not_a_dir / "cache"))
+    assert tokenizer("hello world")["input_ids"]
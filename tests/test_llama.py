@@ -1,5 +1,7 @@
+import dataclasses
 import tempfile
 
+import equinox as eqx
 import jax
 import numpy as np
 import pytest
@@ -16,6 +18,7 @@ from levanter.models.llama import (
     LlamaRMSNorm,
     LlamaRotaryEmbedding,
 )
+from levanter.models.lm_model import LmExample
 from levanter.models.llama import _apply_rotary_pos_emb as levanter_apply_rotary_pos_emb
 from levanter.models.llama import _rotate_half as levanter_rotate_half
 from test_utils import check_load_config, check_model_works_with_seqlen, parameterize_with_configs, skip_if_no_torch
@@ -224,6 +227,33 @@ def test_llama_lm_head_model(num_kv_heads):
     assert out.array.shape == (Batch.size, Pos.size, Vocab.size)
 
 
+def test_llama_checkpointing_defaults_to_per_layer():
+    config = dataclasses.replace(_get_llama_config(), num_layers=10, gradient_checkpointing=True)
+    assert config.checkpoint_segment_size == 1
+
+
+def test_llama_segmented_checkpointing():
+    # opting in to segments of 5 layers, with no per-layer policy
+    config = dataclasses.replace(
+        _get_llama_config(), num_layers=10, gradient_checkpointing=True, gradient_checkpointing_block_size=5
+    )
+    assert config.gradient_checkpointing_policy is None
+    assert config.checkpoint_segment_size == 5
+    Vocab = hax.Axis("vocab", 1000)
+    example = LmExample.causal(hax.random.randint(random.PRNGKey(0), config.Pos, 0, Vocab.size))
+
+    model = LlamaLMHeadModel.init(Vocab=Vocab, config=config, key=random.PRNGKey(0))
+    no_ckpt_model = LlamaLMHeadModel.init(
+        Vocab=Vocab, config=dataclasses.replace(config, gradient_checkpointing=False), key=random.PRNGKey(0)
+    )
+
+    grad = eqx.filter_grad(lambda m: m.compute_loss(example).scalar())(model)
+    no_ckpt_grad = eqx.filter_grad(lambda m: m.compute_loss(example).scalar())(no_ckpt_model)
+
+    for g, g_ref in zip(jax.tree_util.tree_leaves(grad), jax.tree_util.tree_leaves(no_ckpt_grad)):
+        assert np.allclose(g, g_ref, rtol=1e-4, atol=1e-4)
+
+
 @skip_if_no_torch
 @pytest.mark.parametrize("num_kv_heads", [1, 2, 4])
 def test_llama_roundtrip(num_kv_heads):
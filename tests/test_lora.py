@@ -19,6 +19,8 @@ from levanter.lora import (
     save_peft_pretrained,
 )
 from levanter.models.gpt2 import Gpt2Config, Gpt2LMHeadModel
+from levanter.models.lm_model import LmExample
+from levanter.models.mistral import MistralConfig, MistralLMHeadModel
 from levanter.utils.tree_utils import inference_mode
 from test_utils import skip_if_no_torch
 
@@ -116,6 +118,49 @@ def test_lora_peft_integration():
         assert v.shape == hf_dict[k].shape
 
 
+@skip_if_no_torch
+def test_mistral_lora_state_dict_matches_peft():
+    import peft
+    from peft.utils.save_and_load import get_peft_model_state_dict
+    from transformers import MistralForCausalLM
+
+    config = MistralConfig(seq_len=128, hidden_dim=16, intermediate_dim=32, num_layers=2, num_heads=4, num_kv_heads=2)
+    Vocab = hax.Axis("vocab", 1000)
+
+    hf_model = MistralForCausalLM(config.to_hf_config(Vocab.size))
+    peft_model = peft.get_peft_model(hf_model, peft.tuners.LoraConfig(r=8, target_modules=["q_proj", "v_proj"]))
+    hf_dict = get_peft_model_state_dict(peft_model)
+
+    model = MistralLMHeadModel.init(Vocab, config, key=jax.random.PRNGKey(0))
+    lora_config = LoraConfig(r=8, target_modules=["q_proj", "v_proj"])
+    loraized = loraize(model, lora_config, key=jax.random.PRNGKey(0))
+    lev_dict = lora_state_dict(loraized, prefix="base_model.model")
+
+    assert lev_dict.keys() == hf_dict.keys()
+    for k, v in lev_dict.items():
+        assert v.shape == hf_dict[k].shape
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        save_peft_pretrained(loraized, lora_config, "mistralai/Mistral-7B-v0.1", tmpdir, prefix="base_model.model")
+
+
+def test_mistral_lora_all_linears():
+    config = MistralConfig(seq_len=128, hidden_dim=16, intermediate_dim=32, num_layers=2, num_heads=4, num_kv_heads=2)
+    Vocab = hax.Axis("vocab", 1000)
+    model = MistralLMHeadModel.init(Vocab, config, key=jax.random.PRNGKey(0))
+
+    # the default LoraConfig wraps every Linear, including lm_head
+    loraized = loraize(model, LoraConfig(), key=jax.random.PRNGKey(0))
+    assert isinstance(loraized.lm_head, LoraLinear)
+
+    example = LmExample.causal(hax.random.randint(jax.random.PRNGKey(1), config.Pos, 0, Vocab.size))
+    loss = loraized.compute_loss(example)
+    assert np.isfinite(loss.scalar())
+
+    logits = loraized(example.tokens, example.attn_mask)
+    assert logits.axes == (config.Pos, Vocab)
+
+
 def test_merge_lora():
     class Module(eqx.Module):
         first: hnn.Linear
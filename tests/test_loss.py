@@ -0,0 +1,38 @@
+import equinox as eqx
+import jax
+import numpy as np
+import pytest
+from jax import random
+
+import haliax as hax
+
+from levanter.models.loss import fused_lm_head_cross_entropy
+
+
+@pytest.mark.parametrize("seq_len, block_size", [(64, 16), (96, 64), (64, 512), (127, 16)])
+def test_fused_lm_head_cross_entropy_matches_dense(seq_len, block_size):
+    Batch = hax.Axis("batch", 3)
+    Pos = hax.Axis("position", seq_len)
+    Embed = hax.Axis("embed", 8)
+    Vocab = hax.Axis("vocab", 50)
+    k_x, k_head, k_targets = random.split(random.PRNGKey(0), 3)
+
+    x = hax.random.normal(k_x, (Batch, Pos, Embed))
+    lm_head = hax.random.normal(k_head, (Vocab, Embed))
+    targets = hax.random.randint(k_targets, (Batch, Pos), 0, Vocab.size)
+
+    def fused(x, lm_head):
+        return fused_lm_head_cross_entropy(Pos, Embed, Vocab, x, lm_head, targets, block_size=block_size)
+
+    def dense(x, lm_head):
+        logits = hax.dot(Embed, x, lm_head)
+        return hax.nn.cross_entropy_loss(logits, Vocab, hax.nn.one_hot(targets, Vocab), reduction=None)
+
+    fused_loss = fused(x, lm_head)
+    assert fused_loss.axes == targets.axes
+    assert np.allclose(fused_loss.array, dense(x, lm_head).array, rtol=1e-4, atol=1e-4)
+
+    fused_grad = eqx.filter_grad(lambda xw: hax.mean(fused(*xw)).scalar())((x, lm_head))
+    dense_grad = eqx.filter_grad(lambda xw: hax.mean(dense(*xw)).scalar())((x, lm_head))
+    for g, g_ref in zip(jax.tree_util.tree_leaves(fused_grad), jax.tree_util.tree_leaves(dense_grad)):
+        assert np.allclose(g, g_ref, rtol=1e-4, atol=1e-4)
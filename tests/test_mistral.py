@@ -1,5 +1,7 @@
+import dataclasses
 import tempfile
 
+import equinox as eqx
 import jax
 import numpy as np
 import pytest
@@ -8,6 +10,8 @@ from jax import random
 
 import haliax as hax
 
+from levanter.models.attention import AttentionMask
+from levanter.models.lm_model import LmExample, LmHeadModel
 from levanter.models.mistral import MistralConfig, MistralLMHeadModel
 from test_utils import check_load_config, check_model_works_with_seqlen, parameterize_with_configs, skip_if_no_torch
 
@@ -38,6 +42,52 @@ def test_mistral_config():
         ), f"{k} {getattr(new_hf_config, k)} != {getattr(hf_config, k)}"
 
 
+def test_mistral_hf_dict_roundtrip():
+    config = MistralConfig(num_layers=4, sliding_window=1024, tie_word_embeddings=True)
+    assert MistralConfig.from_hf_dict(config.to_hf_dict()) == config
+
+    hf_config = config.to_hf_config(1000)
+    assert hf_config.vocab_size == 1000
+    assert MistralConfig.from_hf_config(hf_config) == config
+
+
+def test_mistral_config_is_static_pytree():
+    config = _get_mistral_config()
+    assert jax.tree_util.tree_leaves(config) == []
+
+    @jax.jit
+    def hidden_dim_times(config, x):
+        return x * config.Embed.size
+
+    assert hidden_dim_times(config, 2.0) == 2.0 * config.hidden_dim
+    assert hidden_dim_times(dataclasses.replace(config, hidden_dim=32), 2.0) == 64.0
+
+
+def test_mistral_to_hf_config_is_cached_but_not_shared():
+    config = _get_mistral_config()
+    hf_config = config.to_hf_config(1000)
+    hf_config.vocab_size = 5
+
+    assert config.to_hf_config(1000).vocab_size == 1000
+    assert config.to_hf_config(2000).vocab_size == 2000
+    assert config.to_hf_config(1000, {"architectures": ["MistralForCausalLM"]}).architectures == ["MistralForCausalLM"]
+
+    # errors from building the config itself aren't mistaken for an uncacheable key
+    with pytest.raises(TypeError):
+        config.to_hf_config(1000, {"hidden_size": 32})
+
+
+def test_mistral_config_axes_are_cached():
+    config = _get_mistral_config()
+    assert config.Pos is config.Pos
+    assert config.HeadSize.size == config.hidden_dim // config.num_heads
+
+    resized = dataclasses.replace(config, seq_len=256)
+    assert resized.Pos.size == 256
+    assert resized.KeyPos == resized.Pos.alias("key_position")
+    assert config.Pos.size == 128
+
+
 @pytest.mark.parametrize("num_kv_heads", [1, 2, 4])
 def test_mistral_lm_head_model(num_kv_heads):
     mistral_config = _get_mistral_config(num_kv_heads=num_kv_heads)
@@ -52,6 +102,145 @@ def test_mistral_lm_head_model(num_kv_heads):
     assert out.array.shape == (Batch.size, Pos.size, Vocab.size)
 
 
+def test_mistral_tied_word_embeddings():
+    config = dataclasses.replace(_get_mistral_config(), tie_word_embeddings=True)
+    Vocab = hax.Axis("vocab", 1000)
+    input_ids = hax.random.randint(random.PRNGKey(0), config.Pos, 0, Vocab.size)
+
+    model = MistralLMHeadModel.init(Vocab=Vocab, config=config, key=random.PRNGKey(0))
+    assert model.lm_head is None
+
+    out = model(input_ids, hax.nn.attention.causal_mask(config.Pos, config.KeyPos))
+    assert out.axes == (config.Pos, Vocab)
+
+    state_dict = model.to_state_dict()
+    assert "lm_head.weight" not in state_dict
+    assert "model.embed_tokens.weight" in state_dict
+
+
+def test_mistral_tied_logits_scale_at_init():
+    # big enough that unscaled std-1 embeddings would give ~16x larger logits than the untied head
+    config = dataclasses.replace(_get_mistral_config(), hidden_dim=256, intermediate_dim=64)
+    Vocab = hax.Axis("vocab", 1000)
+    input_ids = hax.random.randint(random.PRNGKey(0), config.Pos, 0, Vocab.size)
+    mask = AttentionMask.causal()
+
+    untied = MistralLMHeadModel.init(Vocab=Vocab, config=config, key=random.PRNGKey(0))
+    tied = MistralLMHeadModel.init(
+        Vocab=Vocab, config=dataclasses.replace(config, tie_word_embeddings=True), key=random.PRNGKey(0)
+    )
+
+    untied_std = np.std(untied(input_ids, mask).array)
+    tied_std = np.std(tied(input_ids, mask).array)
+    assert untied_std / 4 < tied_std < untied_std * 4
+
+
+def test_mistral_fused_loss_matches_logits():
+    mistral_config = _get_mistral_config()
+    Vocab = hax.Axis("vocab", 1000)
+    input_ids = hax.random.randint(random.PRNGKey(0), mistral_config.Pos, 0, Vocab.size)
+    example = LmExample.causal(input_ids)
+
+    mistral_model = MistralLMHeadModel.init(Vocab=Vocab, config=mistral_config, key=random.PRNGKey(0))
+
+    fused_loss = mistral_model.compute_loss(example, reduction=None)
+    unfused_loss = LmHeadModel.compute_loss(mistral_model, example, reduction=None)
+    assert np.allclose(fused_loss.array, unfused_loss.array, rtol=1e-4, atol=1e-4)
+
+    fused_grad = eqx.filter_grad(lambda m: m.compute_loss(example).scalar())(mistral_model)
+    unfused_grad = eqx.filter_grad(lambda m: LmHeadModel.compute_loss(m, example).scalar())(mistral_model)
+    assert np.allclose(fused_grad.lm_head.weight.array, unfused_grad.lm_head.weight.array, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("num_layers", [4, 6])
+def test_mistral_segmented_checkpointing(num_layers):
+    config = dataclasses.replace(_get_mistral_config(), num_layers=num_layers, gradient_checkpointing=True)
+    assert num_layers % config.checkpoint_segment_size == 0
+    Vocab = hax.Axis("vocab", 1000)
+    example = LmExample.causal(hax.random.randint(random.PRNGKey(0), config.Pos, 0, Vocab.size))
+
+    model = MistralLMHeadModel.init(Vocab=Vocab, config=config, key=random.PRNGKey(0))
+    no_ckpt_model = MistralLMHeadModel.init(
+        Vocab=Vocab, config=dataclasses.replace(config, gradient_checkpointing=False), key=random.PRNGKey(0)
+    )
+
+    grad = eqx.filter_grad(lambda m: m.compute_loss(example).scalar())(model)
+    no_ckpt_grad = eqx.filter_grad(lambda m: m.compute_loss(example).scalar())(no_ckpt_model)
+
+    for g, g_ref in zip(jax.tree_util.tree_leaves(grad), jax.tree_util.tree_leaves(no_ckpt_grad)):
+        assert np.allclose(g, g_ref, rtol=1e-4, atol=1e-4)
+
+    mask = AttentionMask.causal()
+    inference_out = model(example.tokens, mask, inference=True)
+    assert np.allclose(inference_out.array, model(example.tokens, mask).array, rtol=1e-4, atol=1e-4)
+
+
+def test_mistral_flash_attention_falls_back_for_partial_blocks():
+    config = _get_mistral_config(use_flash=True)
+    dense_config = dataclasses.replace(config, use_flash_attention=False)
+    Vocab = hax.Axis("vocab", 1000)
+    model = MistralLMHeadModel.init(Vocab=Vocab, config=config, key=random.PRNGKey(0))
+    dense_model = MistralLMHeadModel.init(Vocab=Vocab, config=dense_config, key=random.PRNGKey(0))
+    mask = AttentionMask.causal()
+
+    # 1 is a decode step, 100 isn't a multiple of the block size, 128 is exactly one block
+    for seq_len in [1, 100, 128]:
+        input_ids = hax.random.randint(random.PRNGKey(0), config.Pos.resize(seq_len), 0, Vocab.size)
+        out = MistralLMHeadModel.jit_step(model, input_ids, mask)
+        assert np.allclose(out.array, dense_model(input_ids, mask).array, rtol=1e-4, atol=1e-4)
+
+
+def test_mistral_jit_step():
+    config = _get_mistral_config()
+    Vocab = hax.Axis("vocab", 1000)
+    model = MistralLMHeadModel.init(Vocab=Vocab, config=config, key=random.PRNGKey(0))
+    mask = AttentionMask.causal()
+
+    for seq_len in [config.Pos.size, config.Pos.size // 2, config.Pos.size]:
+        input_ids = hax.random.randint(random.PRNGKey(0), config.Pos.resize(seq_len), 0, Vocab.size)
+        jit_out = MistralLMHeadModel.jit_step(model, input_ids, mask)
+        assert np.allclose(jit_out.array, model(input_ids, mask).array, rtol=1e-4, atol=1e-4)
+
+
+def test_mistral_resize_vocab():
+    config = _get_mistral_config()
+    Vocab = hax.Axis("vocab", 1000)
+    model = MistralLMHeadModel.init(Vocab=Vocab, config=config, key=random.PRNGKey(0))
+
+    assert model.resize_vocab(Vocab.size) is model
+
+    bigger = model.resize_vocab(1024, key=random.PRNGKey(1))
+    assert bigger.Vocab.size == 1024
+    assert bigger.lm_head.weight.resolve_axis("vocab").size == 1024
+    assert np.array_equal(bigger.lm_head.weight.array[:1000], model.lm_head.weight.array)
+
+    smaller = model.resize_vocab(900)
+    assert smaller.Vocab.size == 900
+    assert np.array_equal(smaller.lm_head.weight.array, model.lm_head.weight.array[:900])
+
+
+@pytest.mark.parametrize("num_kv_heads", [1, 2, 4])
+def test_mistral_fused_qkv_matches_unfused(num_kv_heads):
+    unfused_config = _get_mistral_config(num_kv_heads=num_kv_heads)
+    fused_config = dataclasses.replace(unfused_config, fuse_qkv=True)
+    Vocab = hax.Axis("vocab", 1000)
+    input_ids = hax.random.randint(random.PRNGKey(0), fused_config.Pos, 0, Vocab.size)
+    mask = AttentionMask.causal()
+
+    fused = MistralLMHeadModel.init(Vocab=Vocab, config=fused_config, key=random.PRNGKey(0))
+    state_dict = fused.to_state_dict()
+    assert "model.layers.0.self_attn.q_proj.weight" in state_dict
+    assert not any("qkv_proj" in k for k in state_dict)
+
+    unfused = MistralLMHeadModel.init(Vocab=Vocab, config=unfused_config, key=random.PRNGKey(1))
+    unfused = unfused.from_state_dict(state_dict)
+    assert np.allclose(fused(input_ids, mask).array, unfused(input_ids, mask).array, rtol=1e-4, atol=1e-4)
+
+    refused = MistralLMHeadModel.init(Vocab=Vocab, config=fused_config, key=random.PRNGKey(1))
+    refused = refused.from_state_dict(unfused.to_state_dict())
+    assert np.allclose(fused(input_ids, mask).array, refused(input_ids, mask).array, rtol=1e-4, atol=1e-4)
+
+
 @skip_if_no_torch
 @pytest.mark.parametrize("num_kv_heads", [1, 2, 4])
 def test_mistral_roundtrip(num_kv_heads):